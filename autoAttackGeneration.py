@@ -7,8 +7,37 @@ import html
 from collections import defaultdict
 from graphviz import Digraph
 import math
+import time
+import threading
 import pandas as pd
 
+from snapshot_format import append_snapshot
+
+http_session = requests.Session()
+_csv_cache = {}
+_response_format_supported = True
+# Replaces the HTTP request in callGPT when set, called as chat_transport(prompt_kind, request_body, structured)
+chat_transport = None
+# JSON lines file recording the latency and token usage of every model call, used by cost_planner.py
+LATENCY_LOG_FILE = None
+
+PROMPT_KINDS = ['rewrite', 'countermeasure', 'cwe_steps']
+DEFAULT_MODEL_ROUTE = {
+    "model": "deepseek-r1-distill-qwen-7b",
+    "url": "http://localhost:1234/v1/chat/completions",
+    "temperature": 0.7,
+    "max_tokens": -1
+}
+# Model, endpoint, temperature and token cap used for each prompt kind, see load_model_routes
+MODEL_ROUTES = {kind: dict(DEFAULT_MODEL_ROUTE) for kind in PROMPT_KINDS}
+_call_stats = threading.local()
+_latency_log_lock = threading.Lock()
+
+MAX_ATTACK_STEP_WORDS = 14
+MAX_COUNTERMEASURE_WORDS = 30
+MAX_STRUCTURED_RETRIES = 2
+RETRY_NOTE = "\nYour previous answer did not follow the rules or the JSON format. Write plain sentences of at most {max_words} words and try again."
+
 class Node:
     def __init__(self, originalBody="", actionableBody=""):
         self.originalBody = originalBody
@@ -41,6 +70,16 @@ def count_nodes_excluding_and(node):
         count += count_nodes_excluding_and(child)
     return count
 
+def read_csv_rows(csv_file):
+    rows = _csv_cache.get(csv_file)
+    if rows is None:
+        if not os.path.exists(csv_file):
+            return []
+        with open(csv_file, newline='', encoding='utf-8') as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        _csv_cache[csv_file] = rows
+    return rows
+
 def load_glossary(glossary_file):
     with open(glossary_file, 'r', encoding='utf-8-sig') as f:
         data = json.load(f)
@@ -105,7 +144,7 @@ def adjust_language_complexity(text, complexity):
     else:
         return text
     
-    return callGPT(instructions, text, complexity)
+    return callGPT(instructions, text, complexity, prompt_kind='rewrite')
 
 def parse_execution_flow(execution_flow, language_complexity):
     steps = execution_flow.split('::STEP:')[1:]
@@ -153,38 +192,31 @@ def include_capec(capec_id, capec_dir):
     if capec_id.startswith("CAPEC-"):
         capec_id = capec_id.split('-')[1]
     capec_file = os.path.join(capec_dir, f"capec_{capec_id}.csv")
-    if os.path.exists(capec_file):
-        with open(capec_file, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                abstraction = row['Abstraction']
-                if abstraction in ('Standard', 'Detailed'):
-                    return True
+    for row in read_csv_rows(capec_file):
+        abstraction = row['Abstraction']
+        if abstraction in ('Standard', 'Detailed'):
+            return True
     return False
 
 def parse_related_cwe_ids(related_cwe_text):
     return re.findall(r'::(\d+)::', related_cwe_text)
 
-def generate_cwe_attack_steps_for_all(cwe_ids, cwe_dir, language_complexity, num_steps=3):
+def generate_cwe_attack_steps_for_all(cwe_ids, cwe_dir, language_complexity, num_steps=3, structured_output=False):
     all_cwe_info = ""
     for cwe_id in cwe_ids:
         cwe_file = os.path.join(cwe_dir, f"cwe_{cwe_id}.csv")
-        if os.path.exists(cwe_file):
-            with open(cwe_file, newline='', encoding='utf-8') as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    cwe_info = (
-                        f"Name: {row['Name']}. "
-                        f"Description: {row['Description']}. "
-                        f"Extended Description: {row['Extended Description']}."
-                        f"Observed Examples: {row['Observed Examples']}."
-                    )
-                    all_cwe_info += cwe_info + "\n"
+        for row in read_csv_rows(cwe_file):
+            cwe_info = (
+                f"Name: {row['Name']}. "
+                f"Description: {row['Description']}. "
+                f"Extended Description: {row['Extended Description']}."
+                f"Observed Examples: {row['Observed Examples']}."
+            )
+            all_cwe_info += cwe_info + "\n"
     if not all_cwe_info:
         return []
     
-    base_prompt = (
-        f"Generate {num_steps} concise attack steps following these rules:\n"
+    rules = (
         "1. Each step MUST start with a strong imperative verb (for example, but not limited to 'Intercept', 'Bypass' or 'Brute-force')\n"
         "2. Never use markdown, asterisks (**), bold, italics, or special formatting\n"
         "3. Follow this exact format: '[action verb] [method] to [impact]'\n"
@@ -213,25 +245,58 @@ def generate_cwe_attack_steps_for_all(cwe_ids, cwe_dir, language_complexity, num
     else:
         language_instruction = ""
     
+    if structured_output:
+        return request_structured_cwe_attack_steps(rules, language_instruction, all_cwe_info, language_complexity, num_steps)
+    
+    base_prompt = f"Generate {num_steps} concise attack steps following these rules:\n" + rules
     instructions_cwe = base_prompt + language_instruction + "\nNow generate plain text steps following these rules."
     
-    response = callGPT(instructions_cwe, all_cwe_info, language_complexity)
+    response = callGPT(instructions_cwe, all_cwe_info, language_complexity, prompt_kind='cwe_steps')
     steps = [step.strip() for step in response.split('\n') if step.strip()]
     return steps
 
+def request_structured_cwe_attack_steps(rules, language_instruction, cwe_info, language_complexity, num_steps):
+    steps = []
+    for attempt in range(MAX_STRUCTURED_RETRIES + 1):
+        missing = num_steps - len(steps)
+        if missing <= 0:
+            break
+        instructions_cwe = (
+            f"Generate {missing} concise attack steps following these rules:\n" + rules + language_instruction +
+            f"\nRespond ONLY with a JSON object of the form {{\"steps\": [...]}} containing exactly {missing} plain text steps."
+        )
+        user_input = cwe_info
+        if steps:
+            user_input += "\nDo not repeat these existing steps:\n" + "\n".join(steps)
+        if attempt:
+            user_input += RETRY_NOTE.format(max_words=MAX_ATTACK_STEP_WORDS)
+        schema = {
+            "type": "object",
+            "properties": {
+                "steps": {"type": "array", "items": {"type": "string"}, "minItems": missing, "maxItems": missing}
+            },
+            "required": ["steps"]
+        }
+        response = parse_json_response(callGPT(instructions_cwe, user_input, language_complexity, json_schema_format("attack_steps", schema), 'cwe_steps'))
+        candidates = response.get("steps") if isinstance(response, dict) else None
+        if not isinstance(candidates, list):
+            continue
+        for candidate in candidates[:missing]:
+            step = validate_generated_sentence(candidate, MAX_ATTACK_STEP_WORDS)
+            if step and step not in steps:
+                steps.append(step)
+    return steps
+
 def parse_mitigations(mitigations_text):
     return [m.strip() for m in mitigations_text.split("::") if m.strip()]
 
 def get_cwe_potential_mitigations(cwe_id, cwe_dir):
     potential_mitigations = []
     cwe_file = os.path.join(cwe_dir, f"cwe_{cwe_id}.csv")
-    if os.path.exists(cwe_file):
-        with open(cwe_file, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                pm = row.get('Potential Mitigations', '')
-                if pm:
-                    potential_mitigations.extend([p.strip() for p in pm.split("::") if p.strip()])
+    for row in read_csv_rows(cwe_file):
+        pm = row.get('Potential Mitigations', '')
+        if pm:
+            potential_mitigations.extend([p.strip() for p in pm.split("::") if p.strip()])
     return potential_mitigations
 
 def get_combined_cwe_potential_mitigations(cwe_ids, cwe_dir):
@@ -240,7 +305,7 @@ def get_combined_cwe_potential_mitigations(cwe_ids, cwe_dir):
         combined.extend(get_cwe_potential_mitigations(cwe_id, cwe_dir))
     return combined
 
-def generate_countermeasures_for_attack_method(attack_method_text, mitigation_context, language_complexity):
+def generate_countermeasures_for_attack_method(attack_method_text, mitigation_context, language_complexity, structured_output=False):
     base_prompt = (
         "Generate ONE concise countermeasure using the following input while following these rules:\n"
         "1. The countermeasure must start with a strong imperative verb (e.g., 'Implement', 'Deploy', 'Enforce')\n"
@@ -267,39 +332,168 @@ def generate_countermeasures_for_attack_method(attack_method_text, mitigation_co
     else:
         language_instruction = ""
     
+    combined_input = f"Attack Method: {attack_method_text}\nMitigation Context: {mitigation_context}"
+    
+    if structured_output:
+        instructions_countermeasure = base_prompt + language_instruction + f"\nRespond ONLY with a JSON object of the form {{\"countermeasure\": \"...\"}} containing the single plain text countermeasure sentence of at most {MAX_COUNTERMEASURE_WORDS} words."
+        schema = {
+            "type": "object",
+            "properties": {"countermeasure": {"type": "string"}},
+            "required": ["countermeasure"]
+        }
+        for attempt in range(MAX_STRUCTURED_RETRIES + 1):
+            user_input = combined_input + RETRY_NOTE.format(max_words=MAX_COUNTERMEASURE_WORDS) if attempt else combined_input
+            response = parse_json_response(callGPT(instructions_countermeasure, user_input, language_complexity, json_schema_format("countermeasure", schema), 'countermeasure'))
+            if isinstance(response, dict):
+                countermeasure = validate_generated_sentence(response.get("countermeasure"), MAX_COUNTERMEASURE_WORDS)
+                if countermeasure:
+                    return [countermeasure]
+        return []
+    
     instructions_countermeasure = base_prompt + language_instruction + "\nNow generate ONLY the plain text countermeasure as a single sentence. Do NOT generate multiple countermeasures or anything beyond that single sentence."
     
-    combined_input = f"Attack Method: {attack_method_text}\nMitigation Context: {mitigation_context}"
-    response = callGPT(instructions_countermeasure, combined_input, language_complexity)
+    response = callGPT(instructions_countermeasure, combined_input, language_complexity, prompt_kind='countermeasure')
     steps = [step.strip() for step in response.split('\n') if step.strip()]
     return steps
 
-def callGPT(instructions, originalText, complexity_level):
-    url = 'http://localhost:1234/v1/chat/completions'
-    headers = {"Content-Type": "application/json"}
+def json_schema_format(name, schema):
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+def parse_json_response(response_text):
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", response_text.strip())
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        return None
+    try:
+        return json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+
+def validate_generated_sentence(text, max_words):
+    if not isinstance(text, str):
+        return None
+    text = text.strip().strip('"').strip()
+    if not text or '\n' in text:
+        return None
+    if re.search(r"\*\*|`|^#", text):
+        return None
+    # __word__ is markdown bold unless it looks like an identifier such as __proto__
+    for match in re.finditer(r"(?<!\w)__(\S.*?)__(?!\w)", text):
+        if not re.fullmatch(r"[a-z][a-z0-9_]*", match.group(1)):
+            return None
+    # Only one sentence, ignoring common abbreviations
+    if re.search(r"[.!?]\s+\S", re.sub(r"\b(e\.g|i\.e|etc|vs)\.", "", text, flags=re.IGNORECASE)):
+        return None
+    if re.match(r"^(step\s*\d+|\d+[.):]|[-*\u2022])", text, flags=re.IGNORECASE):
+        return None
+    if len(text.split()) > max_words:
+        return None
+    return text
+
+def load_model_routes(routes_file):
+    with open(routes_file, 'r', encoding='utf-8') as f:
+        routes = json.load(f)
+    # A misspelled kind or field would otherwise silently leave that kind on the default route
+    for kind, route in routes.items():
+        if kind not in PROMPT_KINDS:
+            raise ValueError(f"Unknown prompt kind '{kind}' in {routes_file}, expected one of {PROMPT_KINDS}")
+        unknown_fields = set(route) - set(DEFAULT_MODEL_ROUTE)
+        if unknown_fields:
+            raise ValueError(f"Unknown route fields {sorted(unknown_fields)} for '{kind}' in {routes_file}, expected {list(DEFAULT_MODEL_ROUTE)}")
+    for kind in PROMPT_KINDS:
+        MODEL_ROUTES[kind] = {**DEFAULT_MODEL_ROUTE, **routes.get(kind, {})}
+    return MODEL_ROUTES
+
+def describe_model_routes():
+    return ";".join(
+        f"{kind}={route['model']}@{route['url']}(temperature={route['temperature']},max_tokens={route['max_tokens']})"
+        for kind, route in MODEL_ROUTES.items()
+    )
+
+def reset_call_stats():
+    _call_stats.counts = {kind: {'calls': 0, 'seconds': 0.0, 'completion_tokens': 0} for kind in PROMPT_KINDS}
+
+def get_call_stats():
+    if not hasattr(_call_stats, 'counts'):
+        reset_call_stats()
+    stats = {}
+    for kind, counts in _call_stats.counts.items():
+        stats[f'calls_{kind}'] = counts['calls']
+        stats[f'seconds_{kind}'] = round(counts['seconds'], 3)
+        stats[f'completion_tokens_{kind}'] = counts['completion_tokens']
+    return stats
+
+def callGPT(instructions, originalText, complexity_level, response_format=None, prompt_kind=None):
+    route = MODEL_ROUTES.get(prompt_kind, DEFAULT_MODEL_ROUTE)
+    url = route["url"]
     data = {
-        "model": "deepseek-r1-distill-qwen-7b",
+        "model": route["model"],
         "messages": [
             {"role": "system", "content": instructions},
             {"role": "user", "content": originalText}
         ],
-        "temperature": 0.7,
-        "max_tokens": -1,
+        "temperature": route["temperature"],
+        "max_tokens": route["max_tokens"],
         "stream": False
     }
+    if response_format is not None and _response_format_supported:
+        data["response_format"] = response_format
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    if chat_transport is not None:
+        full_content = chat_transport(prompt_kind, data, response_format is not None)
+    else:
+        full_content = post_chat_request(url, data, prompt_kind)
+    extracted_content = re.sub(r".*</think>\s*", "", full_content, flags=re.DOTALL)
+    return extracted_content.strip()
+
+def post_chat_request(url, data, prompt_kind=None):
+    global _response_format_supported
+    headers = {"Content-Type": "application/json"}
+    start_time = time.time()
+    response = http_session.post(url, headers=headers, data=json.dumps(data))
+    if response.status_code == 400 and "response_format" in data:
+        if response_format_rejected(response):
+            # Server does not support structured output, prompt for JSON only from now on
+            _response_format_supported = False
+        # Other bad requests are retried once without the schema, for this call only
+        data = {k: v for k, v in data.items() if k != "response_format"}
+        response = http_session.post(url, headers=headers, data=json.dumps(data))
 
     if response.status_code == 200:
         response_json = response.json()
-        full_content = response_json["choices"][0]["message"]["content"]
-        extracted_content = re.sub(r".*</think>\s*", "", full_content, flags=re.DOTALL)
-        return extracted_content.strip()
+        seconds = time.time() - start_time
+        usage = response_json.get("usage") or {}
+        if prompt_kind in PROMPT_KINDS:
+            if not hasattr(_call_stats, 'counts'):
+                reset_call_stats()
+            counts = _call_stats.counts[prompt_kind]
+            counts['calls'] += 1
+            counts['seconds'] += seconds
+            counts['completion_tokens'] += usage.get("completion_tokens") or 0
+        if LATENCY_LOG_FILE:
+            log_call_latency(prompt_kind, data, usage, seconds)
+        return response_json["choices"][0]["message"]["content"]
     else:
         print(f"Error: {response.status_code}, {response.text}")
         return ""
 
-def process_capec_graph(capec_id, capec_dir, cwe_dir, current_path=None, duplicates=None, language_complexity='developer', syntax_complexity='full'):
+def response_format_rejected(response):
+    return "response_format" in response.text or "json_schema" in response.text
+
+def log_call_latency(prompt_kind, data, usage, seconds):
+    record = {
+        'prompt_kind': prompt_kind,
+        'model': data["model"],
+        'prompt_chars': sum(len(m["content"]) for m in data["messages"]),
+        'prompt_tokens': usage.get("prompt_tokens"),
+        'completion_tokens': usage.get("completion_tokens"),
+        'seconds': round(seconds, 3)
+    }
+    with _latency_log_lock, open(LATENCY_LOG_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + "\n")
+
+def process_capec_graph(capec_id, capec_dir, cwe_dir, current_path=None, duplicates=None, language_complexity='developer', syntax_complexity='full', structured_output=False):
     if current_path is None:
         current_path = []
     if duplicates is None:
@@ -318,48 +512,30 @@ def process_capec_graph(capec_id, capec_dir, cwe_dir, current_path=None, duplica
         print(f"CAPEC-{capec_id} file not found.")
         return None
     
-    with open(capec_file, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            execution_flow_data = parse_execution_flow(row['Execution Flow'], language_complexity)
-            objectives = [(objective, methods) for objective, methods in execution_flow_data]
-            
-            mitigations_list = parse_mitigations(row.get('Mitigations', ''))
-            adjusted_mitigations = [adjust_language_complexity(m, language_complexity) for m in mitigations_list]
-            
-            cwe_ids = parse_related_cwe_ids(row.get('Related Weaknesses', ''))
-            combined_cwe_potential = get_combined_cwe_potential_mitigations(cwe_ids, cwe_dir)
-            context = "CAPEC mitigations: " + " ".join(adjusted_mitigations)
-            if combined_cwe_potential:
-                context += " CWE potential mitigations: " + " ".join(combined_cwe_potential)
-            
-            root_label = f"{row['Name']} (CAPEC-{capec_id})"
-            if duplicates[capec_id] > 1:
-                root_label += " (duplicate)"
-            root_node = GraphNode(root_label)
-            
-            for mitigation in adjusted_mitigations:
-                root_node.children.append(GraphNode(f"Mitigation: {mitigation}"))
-            
-            if len(objectives) > 1:
-                and_node = GraphNode("AND", is_and=True)
-                for objective, methods in objectives:
-                    objective_text = adjust_language_complexity(objective, language_complexity)
-                    objective_node = GraphNode(f"Attack Objective: {objective_text}")
-                    for method in methods:
-                        attack_label = f"Attack Method: {method.actionableBody}"
-                        attack_method_node = GraphNode(attack_label)
-                        if syntax_complexity in ['countermeasures', 'full']:
-                            generated_countermeasures = generate_countermeasures_for_attack_method(
-                                method.originalBody, context, language_complexity
-                            )
-                            for cm in generated_countermeasures:
-                                attack_method_node.children.append(GraphNode(f"Generated Countermeasure: {cm}"))
-                        objective_node.children.append(attack_method_node)
-                    and_node.children.append(objective_node)
-                root_node.children.append(and_node)
-            elif objectives:
-                objective, methods = objectives[0]
+    for row in read_csv_rows(capec_file):
+        execution_flow_data = parse_execution_flow(row['Execution Flow'], language_complexity)
+        objectives = [(objective, methods) for objective, methods in execution_flow_data]
+        
+        mitigations_list = parse_mitigations(row.get('Mitigations', ''))
+        adjusted_mitigations = [adjust_language_complexity(m, language_complexity) for m in mitigations_list]
+        
+        cwe_ids = parse_related_cwe_ids(row.get('Related Weaknesses', ''))
+        combined_cwe_potential = get_combined_cwe_potential_mitigations(cwe_ids, cwe_dir)
+        context = "CAPEC mitigations: " + " ".join(adjusted_mitigations)
+        if combined_cwe_potential:
+            context += " CWE potential mitigations: " + " ".join(combined_cwe_potential)
+        
+        root_label = f"{row['Name']} (CAPEC-{capec_id})"
+        if duplicates[capec_id] > 1:
+            root_label += " (duplicate)"
+        root_node = GraphNode(root_label)
+        
+        for mitigation in adjusted_mitigations:
+            root_node.children.append(GraphNode(f"Mitigation: {mitigation}"))
+        
+        if len(objectives) > 1:
+            and_node = GraphNode("AND", is_and=True)
+            for objective, methods in objectives:
                 objective_text = adjust_language_complexity(objective, language_complexity)
                 objective_node = GraphNode(f"Attack Objective: {objective_text}")
                 for method in methods:
@@ -367,36 +543,52 @@ def process_capec_graph(capec_id, capec_dir, cwe_dir, current_path=None, duplica
                     attack_method_node = GraphNode(attack_label)
                     if syntax_complexity in ['countermeasures', 'full']:
                         generated_countermeasures = generate_countermeasures_for_attack_method(
-                            method.originalBody, context, language_complexity
+                            method.originalBody, context, language_complexity, structured_output
                         )
                         for cm in generated_countermeasures:
                             attack_method_node.children.append(GraphNode(f"Generated Countermeasure: {cm}"))
                     objective_node.children.append(attack_method_node)
-                root_node.children.append(objective_node)
-            
-            child_nodes = parse_related_patterns(row['Related Attack Patterns'], capec_dir)
-            if child_nodes:
-                for child in child_nodes:
-                    child_id = child.split('-')[1]
-                    child_graph = process_capec_graph(child_id, capec_dir, cwe_dir, 
-                                                     current_path + [capec_id], duplicates,
-                                                     language_complexity, syntax_complexity)
-                    if child_graph is not None:
-                        root_node.children.append(child_graph)
-            
-            if syntax_complexity == 'full' and cwe_ids:
-                cwe_attack_steps = generate_cwe_attack_steps_for_all(cwe_ids, cwe_dir, language_complexity)
-                for step in cwe_attack_steps:
-                    attack_method_node = GraphNode(f"Generated Attack Method: {step}")
-                    if syntax_complexity == 'full':
-                        generated_countermeasures = generate_countermeasures_for_attack_method(
-                            step, context, language_complexity
-                        )
-                        for cm in generated_countermeasures:
-                            attack_method_node.children.append(GraphNode(f"Generated Countermeasure: {cm}"))
-                    root_node.children.append(attack_method_node)
-            
-            return root_node
+                and_node.children.append(objective_node)
+            root_node.children.append(and_node)
+        elif objectives:
+            objective, methods = objectives[0]
+            objective_text = adjust_language_complexity(objective, language_complexity)
+            objective_node = GraphNode(f"Attack Objective: {objective_text}")
+            for method in methods:
+                attack_label = f"Attack Method: {method.actionableBody}"
+                attack_method_node = GraphNode(attack_label)
+                if syntax_complexity in ['countermeasures', 'full']:
+                    generated_countermeasures = generate_countermeasures_for_attack_method(
+                        method.originalBody, context, language_complexity, structured_output
+                    )
+                    for cm in generated_countermeasures:
+                        attack_method_node.children.append(GraphNode(f"Generated Countermeasure: {cm}"))
+                objective_node.children.append(attack_method_node)
+            root_node.children.append(objective_node)
+        
+        child_nodes = parse_related_patterns(row['Related Attack Patterns'], capec_dir)
+        if child_nodes:
+            for child in child_nodes:
+                child_id = child.split('-')[1]
+                child_graph = process_capec_graph(child_id, capec_dir, cwe_dir, 
+                                                 current_path + [capec_id], duplicates,
+                                                 language_complexity, syntax_complexity, structured_output)
+                if child_graph is not None:
+                    root_node.children.append(child_graph)
+        
+        if syntax_complexity == 'full' and cwe_ids:
+            cwe_attack_steps = generate_cwe_attack_steps_for_all(cwe_ids, cwe_dir, language_complexity, structured_output=structured_output)
+            for step in cwe_attack_steps:
+                attack_method_node = GraphNode(f"Generated Attack Method: {step}")
+                if syntax_complexity == 'full':
+                    generated_countermeasures = generate_countermeasures_for_attack_method(
+                        step, context, language_complexity, structured_output
+                    )
+                    for cm in generated_countermeasures:
+                        attack_method_node.children.append(GraphNode(f"Generated Countermeasure: {cm}"))
+                root_node.children.append(attack_method_node)
+        
+        return root_node
     return None
 
 def get_ancestry_chain(capec_id, capec_dir):
@@ -408,18 +600,16 @@ def get_ancestry_chain(capec_id, capec_dir):
         if not os.path.exists(capec_file):
             break
         parent_id = None
-        with open(capec_file, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            row = next(reader, None)
-            if row:
-                related_patterns = row.get('Related Attack Patterns', '')
-                for entry in related_patterns.split('::'):
-                    parts = entry.split(':')
-                    if len(parts) >= 4 and parts[0] == "NATURE" and parts[1] == "ChildOf":
-                        parent_id = parts[3].strip()
-                        if parent_id.startswith("CAPEC-"):
-                            parent_id = parent_id.split('-')[1]
-                        break
+        rows = read_csv_rows(capec_file)
+        if rows:
+            related_patterns = rows[0].get('Related Attack Patterns', '')
+            for entry in related_patterns.split('::'):
+                parts = entry.split(':')
+                if len(parts) >= 4 and parts[0] == "NATURE" and parts[1] == "ChildOf":
+                    parent_id = parts[3].strip()
+                    if parent_id.startswith("CAPEC-"):
+                        parent_id = parent_id.split('-')[1]
+                    break
         if parent_id:
             current_id = parent_id
         else:
@@ -431,31 +621,27 @@ def get_capec_title(capec_id, capec_dir):
     capec_file = os.path.join(capec_dir, f"capec_{capec_id}.csv")
     if not os.path.exists(capec_file):
         return f"CAPEC-{capec_id}"
-    with open(capec_file, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        row = next(reader, None)
-        if row:
-            return row.get('Name', f"CAPEC-{capec_id}")
-        else:
-            return f"CAPEC-{capec_id}"
+    rows = read_csv_rows(capec_file)
+    if rows:
+        return rows[0].get('Name', f"CAPEC-{capec_id}")
+    else:
+        return f"CAPEC-{capec_id}"
 
 def parse_parent_of_relationships_for_capec(capec_id, capec_dir):
     children = []
     capec_file = os.path.join(capec_dir, f"capec_{capec_id}.csv")
     if not os.path.exists(capec_file):
         return children
-    with open(capec_file, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        row = next(reader, None)
-        if row:
-            related_patterns = row.get('Related Attack Patterns', '')
-            for entry in related_patterns.split('::'):
-                parts = entry.split(':')
-                if len(parts) >= 4 and parts[0] == "NATURE" and parts[1] == "ParentOf":
-                    child_id = parts[3].strip()
-                    if child_id.startswith("CAPEC-"):
-                        child_id = child_id.split('-')[1]
-                    children.append(child_id)
+    rows = read_csv_rows(capec_file)
+    if rows:
+        related_patterns = rows[0].get('Related Attack Patterns', '')
+        for entry in related_patterns.split('::'):
+            parts = entry.split(':')
+            if len(parts) >= 4 and parts[0] == "NATURE" and parts[1] == "ParentOf":
+                child_id = parts[3].strip()
+                if child_id.startswith("CAPEC-"):
+                    child_id = child_id.split('-')[1]
+                children.append(child_id)
     return children
 
 def build_ancestry_subtree_graph(chain, index, capec_dir, elaborated_tree):
@@ -524,30 +710,25 @@ def add_nodes_edges(dot, graph_node, node_mapping, mapping_counter, and_counter,
     for child in graph_node.children:
         add_nodes_edges(dot, child, node_mapping, parent_id=current_id, mapping_counter=mapping_counter, and_counter=and_counter)
 
-def generate_attack_tree_graph(capec_id, language_complexity='developer', syntax_complexity='full', render=True, verbose=True):
+def build_attack_tree(capec_id, language_complexity='developer', syntax_complexity='full', duplicates=None, capec_dir="./capec_data/", cwe_dir="./cwe_data/", structured_output=False):
     starting_capec_id = f"CAPEC-{capec_id}"
-    capec_dir = "./capec_data/"
-    cwe_dir = "./cwe_data/"
-    glossary_file = "nist_glossary.json"
-    duplicates = defaultdict(int)
-    
-    glossary_terms = load_glossary(glossary_file)
+    if duplicates is None:
+        duplicates = defaultdict(int)
     
     elaborated_tree = process_capec_graph(starting_capec_id, capec_dir, cwe_dir, 
                                         duplicates=duplicates, 
                                         language_complexity=language_complexity,
-                                        syntax_complexity=syntax_complexity)
+                                        syntax_complexity=syntax_complexity,
+                                        structured_output=structured_output)
     if elaborated_tree is None:
-        if verbose:
-            print("No attack-defense tree generated.")
         return None
     
     ancestry_chain = get_ancestry_chain(starting_capec_id, capec_dir)
     if len(ancestry_chain) > 1:
-        full_tree = build_ancestry_subtree_graph(ancestry_chain, 0, capec_dir, elaborated_tree)
-    else:
-        full_tree = elaborated_tree
-    
+        return build_ancestry_subtree_graph(ancestry_chain, 0, capec_dir, elaborated_tree)
+    return elaborated_tree
+
+def score_attack_tree(full_tree, glossary_terms):
     total_nodes = count_nodes_excluding_and(full_tree)
     syntax_complexity_number = max(0, min(1, (total_nodes - 5) / 155.0))
     
@@ -555,54 +736,93 @@ def generate_attack_tree_graph(capec_id, language_complexity='developer', syntax
     language_complexity_score = total_matches / total_words if total_words > 0 else 0
     total_complexity = (language_complexity_score + syntax_complexity_number)/2
     
+    return {
+        'language_score': language_complexity_score,
+        'syntax_score': syntax_complexity_number,
+        'total_score': total_complexity,
+        'total_nodes': total_nodes,
+        'total_words': total_words,
+        'total_matches': total_matches
+    }
+
+def render_attack_tree(full_tree, output_filename):
+    dot = Digraph(comment="CAPEC Attack-Defense Tree")
+    node_mapping = {}
+    mapping_counter = [1]
+    and_counter = [1]
+    add_nodes_edges(dot, full_tree, node_mapping, mapping_counter, and_counter)
+    
+    with dot.subgraph(name='cluster_legend') as c:
+        c.attr(label='Node Types', style='dashed')
+        legend_html = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" CELLPADDING="4">'
+        legend_html += '<TR><TD COLSPAN="2"><B>Color Codes</B></TD></TR>'
+        legend_html += '<TR><TD bgcolor="lightblue"> </TD><TD><b>Main Nodes:</b> CAPEC entries with title and ID</TD></TR>'
+        legend_html += '<TR><TD bgcolor="red"> </TD><TD><b>Attack Objective Nodes:</b> Derived from CAPEC execution flow</TD></TR>'
+        legend_html += '<TR><TD bgcolor="yellow"> </TD><TD><b>Attack Method Nodes:</b> Derived from execution flow</TD></TR>'
+        legend_html += '<TR><TD bgcolor="orange"> </TD><TD><b>Generated Attack Method Nodes:</b> LLM-generated attack methods</TD></TR>'
+        legend_html += '<TR><TD bgcolor="lightgreen"> </TD><TD><b>Mitigation Nodes:</b> Derived from the CAPEC mitigations</TD></TR>'
+        legend_html += '<TR><TD bgcolor="forestgreen"> </TD><TD><b>Generated Countermeasure Nodes:</b> LLM-generated countermeasures</TD></TR>'
+        legend_html += '<TR><TD bgcolor="gray80"> </TD><TD><b>Other Children Nodes:</b> Nodes representing non-expanded children</TD></TR>'
+        legend_html += '</TABLE>>'
+        c.node('legend', legend_html, shape='none')
+    
+    mapping_html = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" CELLPADDING="4">'
+    mapping_html += '<TR><TD COLSPAN="2"><B>Node Mapping</B></TD></TR>'
+    for key in sorted(node_mapping.keys(), key=lambda x: int(x.replace("node", ""))):
+        mapping_text = html.escape(node_mapping[key])
+        mapping_html += f'<TR><TD>{key}</TD><TD>{mapping_text}</TD></TR>'
+    mapping_html += '</TABLE>>'
+    
+    with dot.subgraph(name='cluster_mapping') as c2:
+        c2.attr(rank='sink', label='Node Mappings', style='dashed')
+        c2.node('mapping', mapping_html, shape='none')
+    
+    with dot.subgraph(name='sink_cluster') as s:
+        s.attr(rank='sink')
+        s.node('dummy_sink', '', style='invis')
+        s.edge('dummy_sink', 'mapping', style='invis')
+    
+    return dot.render(output_filename, format='pdf', cleanup=True)
+
+def generate_attack_tree_graph(capec_id, language_complexity='developer', syntax_complexity='full', render=True, verbose=True, glossary_terms=None, structured_output=False, snapshot_file=None):
+    glossary_file = "nist_glossary.json"
+    duplicates = defaultdict(int)
+    
+    if glossary_terms is None:
+        glossary_terms = load_glossary(glossary_file)
+    
+    reset_call_stats()
+    full_tree = build_attack_tree(capec_id, language_complexity, syntax_complexity, duplicates, structured_output=structured_output)
+    if full_tree is None:
+        if verbose:
+            print("No attack-defense tree generated.")
+        return None
+    
+    if snapshot_file:
+        append_snapshot(snapshot_file, full_tree, {
+            'capec_id': capec_id,
+            'language_complexity': language_complexity,
+            'syntax_complexity': syntax_complexity,
+            'structured_output': structured_output,
+            'routing': describe_model_routes()
+        })
+    
+    metrics = score_attack_tree(full_tree, glossary_terms)
+    metrics.update(get_call_stats())
+    metrics['routing'] = describe_model_routes()
+    
     if verbose:
         print(f"\nStatistics for CAPEC-{capec_id} with {language_complexity} and {syntax_complexity}:")
-        print(f"Total number of words in the nodes: {total_words}")
-        print(f"Total number of matches with glossary terms: {total_matches}")
-        print(f"Language complexity: {language_complexity_score:.4f}")
-        print(f"Total number of nodes (excluding AND-nodes): {total_nodes}")
-        print(f"Syntax complexity: {syntax_complexity_number:.4f}")
-        print(f"Total complexity: {total_complexity:.4f}")
+        print(f"Total number of words in the nodes: {metrics['total_words']}")
+        print(f"Total number of matches with glossary terms: {metrics['total_matches']}")
+        print(f"Language complexity: {metrics['language_score']:.4f}")
+        print(f"Total number of nodes (excluding AND-nodes): {metrics['total_nodes']}")
+        print(f"Syntax complexity: {metrics['syntax_score']:.4f}")
+        print(f"Total complexity: {metrics['total_score']:.4f}")
     
     if render:
-        dot = Digraph(comment="CAPEC Attack-Defense Tree")
-        node_mapping = {}
-        mapping_counter = [1]
-        and_counter = [1]
-        add_nodes_edges(dot, full_tree, node_mapping, mapping_counter, and_counter)
-        
-        with dot.subgraph(name='cluster_legend') as c:
-            c.attr(label='Node Types', style='dashed')
-            legend_html = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" CELLPADDING="4">'
-            legend_html += '<TR><TD COLSPAN="2"><B>Color Codes</B></TD></TR>'
-            legend_html += '<TR><TD bgcolor="lightblue"> </TD><TD><b>Main Nodes:</b> CAPEC entries with title and ID</TD></TR>'
-            legend_html += '<TR><TD bgcolor="red"> </TD><TD><b>Attack Objective Nodes:</b> Derived from CAPEC execution flow</TD></TR>'
-            legend_html += '<TR><TD bgcolor="yellow"> </TD><TD><b>Attack Method Nodes:</b> Derived from execution flow</TD></TR>'
-            legend_html += '<TR><TD bgcolor="orange"> </TD><TD><b>Generated Attack Method Nodes:</b> LLM-generated attack methods</TD></TR>'
-            legend_html += '<TR><TD bgcolor="lightgreen"> </TD><TD><b>Mitigation Nodes:</b> Derived from the CAPEC mitigations</TD></TR>'
-            legend_html += '<TR><TD bgcolor="forestgreen"> </TD><TD><b>Generated Countermeasure Nodes:</b> LLM-generated countermeasures</TD></TR>'
-            legend_html += '<TR><TD bgcolor="gray80"> </TD><TD><b>Other Children Nodes:</b> Nodes representing non-expanded children</TD></TR>'
-            legend_html += '</TABLE>>'
-            c.node('legend', legend_html, shape='none')
-        
-        mapping_html = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" CELLPADDING="4">'
-        mapping_html += '<TR><TD COLSPAN="2"><B>Node Mapping</B></TD></TR>'
-        for key in sorted(node_mapping.keys(), key=lambda x: int(x.replace("node", ""))):
-            mapping_text = html.escape(node_mapping[key])
-            mapping_html += f'<TR><TD>{key}</TD><TD>{mapping_text}</TD></TR>'
-        mapping_html += '</TABLE>>'
-        
-        with dot.subgraph(name='cluster_mapping') as c2:
-            c2.attr(rank='sink', label='Node Mappings', style='dashed')
-            c2.node('mapping', mapping_html, shape='none')
-        
-        with dot.subgraph(name='sink_cluster') as s:
-            s.attr(rank='sink')
-            s.node('dummy_sink', '', style='invis')
-            s.edge('dummy_sink', 'mapping', style='invis')
-        
         output_filename = f'attack_defense_tree_{language_complexity}_{syntax_complexity}_{capec_id}'
-        dot.render(output_filename, format='pdf', cleanup=True)
+        render_attack_tree(full_tree, output_filename)
         if verbose:
             print(f"Graph rendered to {output_filename}.pdf")
     
@@ -612,14 +832,7 @@ def generate_attack_tree_graph(capec_id, language_complexity='developer', syntax
             if count > 1:
                 print(f"- CAPEC-{cid} appears {count} times in the tree")
     
-    return {
-        'language_score': language_complexity_score,
-        'syntax_score': syntax_complexity_number,
-        'total_score': total_complexity,
-        'total_nodes': total_nodes,
-        'total_words': total_words,
-        'total_matches': total_matches
-    }
+    return metrics
 
 if __name__ == "__main__":
     # Include one or many capec IDs in this array
@@ -629,7 +842,17 @@ if __name__ == "__main__":
     # Options: ['basic', 'countermeasures', 'full']
     syntax_complexities = ['basic', 'countermeasures', 'full']
     
+    # Optional JSON file mapping 'rewrite', 'countermeasure' and 'cwe_steps' to a model, url, temperature and max_tokens
+    routes_file = None
+    if routes_file:
+        load_model_routes(routes_file)
+    # Optional JSON lines file recording the latency of every model call, for cost_planner.py --calibration
+    latency_log_file = None
+    if latency_log_file:
+        LATENCY_LOG_FILE = latency_log_file
+    
     results = []
+    glossary_terms = load_glossary("nist_glossary.json")
     
     for capec_id in capec_ids:
         for lang in language_complexities:
@@ -640,7 +863,10 @@ if __name__ == "__main__":
                     language_complexity=lang,
                     syntax_complexity=syn,
                     render=False,  # True if you want the graph, False for batch processing/complexity analysis
-                    verbose=False  # True for detailed output, False for suppressing detailed output during batch processing
+                    verbose=False,  # True for detailed output, False for suppressing detailed output during batch processing
+                    glossary_terms=glossary_terms,
+                    structured_output=False,  # True to request JSON output from the model and retry only invalid countermeasures/attack steps
+                    snapshot_file=None  # e.g. 'attack_trees.snap' to store the trees for re-scoring/re-rendering with tree_snapshots.py
                 )
                 if complexities:
                     results.append({
@@ -653,11 +879,13 @@ if __name__ == "__main__":
                     print(f"Failed to process CAPEC-{capec_id} with {lang} and {syn}")
     
     df = pd.DataFrame(results)
+    df.to_csv('complexity_results.csv', index=False)
     
-    averages = df.groupby(['language_complexity', 'syntax_complexity']).mean().reset_index()
+    averages = df.groupby(['language_complexity', 'syntax_complexity']).mean(numeric_only=True).reset_index()
     
     averages = averages[['language_complexity', 'syntax_complexity', 'language_score', 'syntax_score', 'total_score']]
     averages[['language_score', 'syntax_score', 'total_score']] = averages[['language_score', 'syntax_score', 'total_score']].round(4)
     
     averages.to_csv('complexity_averages.csv', index=False)
+    print("Results saved to 'complexity_results.csv'")
     print("Averages saved to 'complexity_averages.csv'")
\ No newline at end of file
@@ -0,0 +1,257 @@
+import os
+import csv
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from requests.adapters import HTTPAdapter
+
+import autoAttackGeneration as aag
+from snapshot_format import append_snapshot
+
+BATCH_URL = "/v1/chat/completions"
+# Stands in for model output that is not available yet. Prompts built from it are deferred to a later round
+PENDING = "\x00pending"
+MAX_ROUNDS = 10
+# Cleared once the server rejects response_format, later requests are sent without it.
+# The planned bodies keep the schema so their custom_ids stay the same between rounds
+_response_format_supported = True
+
+def request_custom_id(prompt_kind, body):
+    digest = hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+    return f"{prompt_kind}-{digest}"
+
+def pending_placeholder(prompt_kind, structured):
+    if not structured:
+        return PENDING
+    if prompt_kind == 'cwe_steps':
+        return json.dumps({"steps": [f"{PENDING}{i}" for i in range(10)]})
+    return json.dumps({"countermeasure": PENDING})
+
+class ResultsTransport:
+    def __init__(self, results):
+        self.results = results
+        self.missing = {}
+
+    def __call__(self, prompt_kind, data, structured):
+        if any(PENDING in message["content"] for message in data["messages"]):
+            return pending_placeholder(prompt_kind, structured)
+        custom_id = request_custom_id(prompt_kind, data)
+        if custom_id in self.results:
+            return self.results[custom_id]
+        # routed_url records where the request was routed when planning, so execute does not depend on --routes
+        self.missing.setdefault(custom_id, {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": BATCH_URL,
+            "body": data,
+            "routed_url": aag.MODEL_ROUTES.get(prompt_kind, aag.DEFAULT_MODEL_ROUTE)["url"]
+        })
+        return pending_placeholder(prompt_kind, structured)
+
+def tree_is_complete(node):
+    if PENDING in node.label:
+        return False
+    return all(tree_is_complete(child) for child in node.children)
+
+def load_results(results_file):
+    results = {}
+    if not results_file or not os.path.exists(results_file):
+        return results
+    with open(results_file, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") == 200:
+                results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return results
+
+def build_job_trees(jobs, results, structured_output=False):
+    transport = ResultsTransport(results)
+    trees = {}
+    previous_transport = aag.chat_transport
+    aag.chat_transport = transport
+    try:
+        for job in jobs:
+            capec_id, language_complexity, syntax_complexity = job
+            full_tree = aag.build_attack_tree(capec_id, language_complexity, syntax_complexity, defaultdict(int),
+                                              structured_output=structured_output)
+            if full_tree is None:
+                print(f"Failed to process CAPEC-{capec_id} with {language_complexity} and {syntax_complexity}")
+            trees[job] = full_tree
+    finally:
+        aag.chat_transport = previous_transport
+    return trees, transport.missing
+
+def plan_requests(jobs, results_file, work_file, structured_output=False):
+    trees, missing = build_job_trees(jobs, load_results(results_file), structured_output)
+    with open(work_file, 'w', encoding='utf-8') as f:
+        for request in missing.values():
+            f.write(json.dumps(request) + "\n")
+    complete = sum(1 for tree in trees.values() if tree is not None and tree_is_complete(tree))
+    print(f"Wrote {len(missing)} requests to {work_file} ({complete}/{len(jobs)} trees complete)")
+    return len(missing)
+
+def request_url(endpoint, request):
+    if endpoint:
+        return endpoint + request["url"]
+    # Without an explicit endpoint each request goes to the server its prompt kind was routed to when planning
+    if request.get("routed_url"):
+        return request["routed_url"]
+    prompt_kind = request["custom_id"].rsplit('-', 1)[0]
+    route = aag.MODEL_ROUTES.get(prompt_kind, aag.DEFAULT_MODEL_ROUTE)
+    if request["body"].get("model") != route["model"]:
+        raise ValueError(f"Request {request['custom_id']} is for model {request['body'].get('model')} but {prompt_kind} "
+                         f"is routed to {route['model']}, pass the same --routes used for planning or --endpoint")
+    return route["url"]
+
+def execute_request(endpoint, request):
+    global _response_format_supported
+    data = request["body"]
+    if not _response_format_supported:
+        data = {k: v for k, v in data.items() if k != "response_format"}
+    url = request_url(endpoint, request)
+    start_time = time.time()
+    response = aag.http_session.post(url, json=data)
+    if response.status_code == 400 and "response_format" in data:
+        if aag.response_format_rejected(response):
+            _response_format_supported = False
+        data = {k: v for k, v in data.items() if k != "response_format"}
+        response = aag.http_session.post(url, json=data)
+    if response.status_code == 200:
+        response_json = response.json()
+        if aag.LATENCY_LOG_FILE:
+            prompt_kind = request["custom_id"].rsplit('-', 1)[0]
+            aag.log_call_latency(prompt_kind, data, response_json.get("usage") or {}, time.time() - start_time)
+        return {"custom_id": request["custom_id"], "response": {"status_code": 200, "body": response_json}, "error": None}
+    return {"custom_id": request["custom_id"], "response": {"status_code": response.status_code, "body": None},
+            "error": {"message": response.text}}
+
+def execute_requests(work_file, results_file, endpoint=None, workers=16):
+    done = load_results(results_file)
+    with open(work_file, encoding='utf-8') as f:
+        requests_to_run = [json.loads(line) for line in f if line.strip()]
+    requests_to_run = [r for r in requests_to_run if r["custom_id"] not in done]
+
+    # The default adapter pools only 10 connections per host, size it for the worker threads
+    adapter = HTTPAdapter(pool_maxsize=workers)
+    aag.http_session.mount("http://", adapter)
+    aag.http_session.mount("https://", adapter)
+
+    write_lock = threading.Lock()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(results_file, 'a', encoding='utf-8') as out:
+        futures = [executor.submit(execute_request, endpoint, request) for request in requests_to_run]
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Error: {e}")
+                continue
+            if record["error"]:
+                failed += 1
+            with write_lock:
+                out.write(json.dumps(record) + "\n")
+    print(f"Executed {len(requests_to_run)} requests against {endpoint or 'the routed endpoints'} ({failed} failed)")
+
+def assemble_trees(jobs, results_file, output_file, glossary_file="nist_glossary.json", structured_output=False, snapshot_file=None):
+    trees, missing = build_job_trees(jobs, load_results(results_file), structured_output)
+    glossary_terms = aag.load_glossary(glossary_file)
+    rows = []
+    for job, full_tree in trees.items():
+        capec_id, language_complexity, syntax_complexity = job
+        if full_tree is None:
+            continue
+        if not tree_is_complete(full_tree):
+            print(f"CAPEC-{capec_id} with {language_complexity} and {syntax_complexity} is missing model results")
+            continue
+        metadata = {
+            'capec_id': capec_id,
+            'language_complexity': language_complexity,
+            'syntax_complexity': syntax_complexity,
+            'routing': aag.describe_model_routes()
+        }
+        if snapshot_file:
+            append_snapshot(snapshot_file, full_tree, {**metadata, 'structured_output': structured_output})
+        rows.append({**metadata, **aag.score_attack_tree(full_tree, glossary_terms)})
+
+    if rows:
+        with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+    print(f"Assembled {len(rows)}/{len(jobs)} trees to '{output_file}' ({len(missing)} requests still missing)")
+    return rows
+
+def add_job_arguments(parser):
+    parser.add_argument('--capec-ids', nargs='+', default=[str(i) for i in range(1, 21)])
+    parser.add_argument('--languages', nargs='+', default=['non-technical', 'developer', 'expert'])
+    parser.add_argument('--syntaxes', nargs='+', default=['basic', 'countermeasures', 'full'])
+    parser.add_argument('--structured', action='store_true', help="Use structured_output=True")
+    parser.add_argument('--results', default='batch_results.jsonl')
+    parser.add_argument('--routes', help="JSON file with the model route for each prompt kind")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate attack-defense trees by planning all prompts, executing them in bulk and assembling the trees.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = subparsers.add_parser('plan', help="Write the prompts still needed to a batch request file")
+    add_job_arguments(plan_parser)
+    plan_parser.add_argument('--work', default='batch_requests.jsonl')
+
+    execute_parser = subparsers.add_parser('execute', help="Run a batch request file against the local server")
+    execute_parser.add_argument('work')
+    execute_parser.add_argument('--results', default='batch_results.jsonl')
+    execute_parser.add_argument('--endpoint', help="Send every request to this server instead of the routed ones")
+    execute_parser.add_argument('--routes', help="JSON file with the model route for each prompt kind")
+    execute_parser.add_argument('--latency-log', help="Append the latency of every request to this file, for cost_planner.py --calibration")
+    execute_parser.add_argument('--workers', type=int, default=16)
+
+    assemble_parser = subparsers.add_parser('assemble', help="Build the trees and metrics from the results file")
+    add_job_arguments(assemble_parser)
+    assemble_parser.add_argument('--output', default='batch_complexities.csv')
+    assemble_parser.add_argument('--glossary', default='nist_glossary.json')
+    assemble_parser.add_argument('--snapshot-file')
+
+    run_parser = subparsers.add_parser('run', help="Plan and execute until every prompt is answered, then assemble")
+    add_job_arguments(run_parser)
+    run_parser.add_argument('--work', default='batch_requests.jsonl')
+    run_parser.add_argument('--endpoint', help="Send every request to this server instead of the routed ones")
+    run_parser.add_argument('--latency-log', help="Append the latency of every request to this file, for cost_planner.py --calibration")
+    run_parser.add_argument('--workers', type=int, default=16)
+    run_parser.add_argument('--output', default='batch_complexities.csv')
+    run_parser.add_argument('--glossary', default='nist_glossary.json')
+    run_parser.add_argument('--snapshot-file')
+
+    args = parser.parse_args()
+    if args.routes:
+        aag.load_model_routes(args.routes)
+    if getattr(args, 'latency_log', None):
+        aag.LATENCY_LOG_FILE = args.latency_log
+    if args.command == 'execute':
+        execute_requests(args.work, args.results, args.endpoint, args.workers)
+    else:
+        jobs = list(itertools.product(args.capec_ids, args.languages, args.syntaxes))
+        if args.command == 'plan':
+            plan_requests(jobs, args.results, args.work, args.structured)
+        elif args.command == 'assemble':
+            assemble_trees(jobs, args.results, args.output, args.glossary, args.structured, args.snapshot_file)
+        else:
+            # Later prompts depend on earlier answers (e.g. countermeasures use the rewritten mitigations),
+            # so plan and execute in rounds until nothing is missing
+            for _ in range(MAX_ROUNDS):
+                if plan_requests(jobs, args.results, args.work, args.structured) == 0:
+                    break
+                execute_requests(args.work, args.results, args.endpoint, args.workers)
+            else:
+                if plan_requests(jobs, args.results, args.work, args.structured):
+                    print(f"Stopped after {MAX_ROUNDS} rounds with requests still missing, the assembled trees are incomplete")
+            assemble_trees(jobs, args.results, args.output, args.glossary, args.structured, args.snapshot_file)
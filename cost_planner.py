@@ -0,0 +1,187 @@
+import os
+import json
+import math
+import argparse
+from collections import defaultdict
+
+import autoAttackGeneration as aag
+
+# Used when no latency log is given or it has no calls of that kind
+DEFAULT_SECONDS_PER_CALL = {'rewrite': 3.0, 'countermeasure': 8.0, 'cwe_steps': 12.0}
+DEFAULT_COMPLETION_TOKENS = {'rewrite': 250, 'countermeasure': 600, 'cwe_steps': 900}
+DEFAULT_CHARS_PER_TOKEN = 4.0
+
+PLACEHOLDER_STEPS = [
+    "Exploit weak input validation to gain unauthorized access",
+    "Intercept unencrypted traffic to steal session credentials",
+    "Inject crafted payloads to execute arbitrary commands"
+]
+PLACEHOLDER_COUNTERMEASURE = "Enforce strict input validation to prevent unauthorized access"
+
+def estimate_tokens(text, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+    return math.ceil(len(text) / chars_per_token)
+
+class DryRunTransport:
+    def __init__(self, chars_per_token=None):
+        self.calls = defaultdict(int)
+        self.prompt_tokens = defaultdict(int)
+        self.chars_per_token = chars_per_token or {}
+
+    def __call__(self, prompt_kind, data, structured):
+        instructions = data["messages"][0]["content"]
+        user_text = data["messages"][1]["content"]
+        chars_per_token = self.chars_per_token.get(prompt_kind, DEFAULT_CHARS_PER_TOKEN)
+        self.calls[prompt_kind] += 1
+        self.prompt_tokens[prompt_kind] += estimate_tokens(instructions + user_text, chars_per_token)
+
+        if prompt_kind == 'cwe_steps':
+            return json.dumps({"steps": PLACEHOLDER_STEPS}) if structured else "\n".join(PLACEHOLDER_STEPS)
+        if prompt_kind == 'countermeasure':
+            return json.dumps({"countermeasure": PLACEHOLDER_COUNTERMEASURE}) if structured else PLACEHOLDER_COUNTERMEASURE
+        # Rewrites are assumed to be about as long as the text they replace
+        return user_text
+
+def load_calibration(latency_log=None, model_routes=None):
+    seconds = dict(DEFAULT_SECONDS_PER_CALL)
+    completion_tokens = dict(DEFAULT_COMPLETION_TOKENS)
+    chars_per_token = {kind: DEFAULT_CHARS_PER_TOKEN for kind in aag.PROMPT_KINDS}
+    if latency_log and os.path.exists(latency_log):
+        recorded_seconds = defaultdict(list)
+        recorded_tokens = defaultdict(list)
+        recorded_prompt_chars = defaultdict(int)
+        recorded_prompt_tokens = defaultdict(int)
+        with open(latency_log, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                kind = record.get('prompt_kind')
+                # Only calibrate from calls made with the model each kind is routed to
+                if model_routes and kind in model_routes and record.get('model') != model_routes[kind]['model']:
+                    continue
+                recorded_seconds[kind].append(record['seconds'])
+                if record.get('completion_tokens') is not None:
+                    recorded_tokens[kind].append(record['completion_tokens'])
+                if record.get('prompt_tokens') and record.get('prompt_chars'):
+                    recorded_prompt_chars[kind] += record['prompt_chars']
+                    recorded_prompt_tokens[kind] += record['prompt_tokens']
+        for kind, values in recorded_seconds.items():
+            seconds[kind] = sum(values) / len(values)
+        for kind, values in recorded_tokens.items():
+            completion_tokens[kind] = sum(values) / len(values)
+        for kind, tokens in recorded_prompt_tokens.items():
+            chars_per_token[kind] = recorded_prompt_chars[kind] / tokens
+    return {'seconds': seconds, 'completion_tokens': completion_tokens, 'chars_per_token': chars_per_token}
+
+def count_node_types(node, counts):
+    if node.is_and:
+        counts['and_nodes'] += 1
+    else:
+        counts['nodes'] += 1
+        for prefix, key in [("Attack Objective: ", 'objectives'), ("Attack Method: ", 'techniques'),
+                            ("Generated Attack Method: ", 'generated_attack_methods'), ("Mitigation: ", 'mitigations'),
+                            ("Generated Countermeasure: ", 'generated_countermeasures')]:
+            if node.label.startswith(prefix):
+                counts[key] += 1
+                break
+    for child in node.children:
+        count_node_types(child, counts)
+    return counts
+
+def plan_job(capec_id, language_complexity, syntax_complexity, calibration, structured_output=False, capec_dir="./capec_data/", cwe_dir="./cwe_data/"):
+    transport = DryRunTransport(calibration.get('chars_per_token'))
+    duplicates = defaultdict(int)
+    previous_transport = aag.chat_transport
+    aag.chat_transport = transport
+    try:
+        full_tree = aag.build_attack_tree(capec_id, language_complexity, syntax_complexity, duplicates,
+                                          capec_dir, cwe_dir, structured_output=structured_output)
+    finally:
+        aag.chat_transport = previous_transport
+    if full_tree is None:
+        return None
+
+    counts = count_node_types(full_tree, defaultdict(int))
+    cwe_lookups = 0
+    for cid, count in duplicates.items():
+        for row in aag.read_csv_rows(os.path.join(capec_dir, f"capec_{cid}.csv"))[:1]:
+            cwe_lookups += count * len(aag.parse_related_cwe_ids(row.get('Related Weaknesses', '')))
+
+    plan = {
+        'capec_id': capec_id,
+        'language_complexity': language_complexity,
+        'syntax_complexity': syntax_complexity,
+        'total_nodes': counts['nodes'],
+        'objectives': counts['objectives'],
+        'techniques': counts['techniques'],
+        'mitigations': counts['mitigations'],
+        'can_follow_expansions': sum(duplicates.values()) - 1,
+        'cwe_lookups': cwe_lookups,
+        'routing': aag.describe_model_routes(),
+        'calls': sum(transport.calls.values()),
+        'prompt_tokens': sum(transport.prompt_tokens.values()),
+        'completion_tokens': 0,
+        'minutes': 0.0
+    }
+    for kind in aag.PROMPT_KINDS:
+        calls = transport.calls[kind]
+        plan[f'calls_{kind}'] = calls
+        plan[f'prompt_tokens_{kind}'] = transport.prompt_tokens[kind]
+        plan['completion_tokens'] += round(calls * calibration['completion_tokens'][kind])
+        plan['minutes'] += calls * calibration['seconds'][kind] / 60.0
+    plan['minutes'] = round(plan['minutes'], 2)
+    return plan
+
+def plan_jobs(capec_ids, language_complexities, syntax_complexities, calibration, structured_output=False, max_calls=None, max_minutes=None):
+    accepted = []
+    rejected = []
+    for capec_id in capec_ids:
+        for lang in language_complexities:
+            for syn in syntax_complexities:
+                plan = plan_job(capec_id, lang, syn, calibration, structured_output)
+                if plan is None:
+                    print(f"Failed to plan CAPEC-{capec_id} with {lang} and {syn}")
+                    continue
+                if (max_calls is not None and plan['calls'] > max_calls) or \
+                        (max_minutes is not None and plan['minutes'] > max_minutes):
+                    rejected.append(plan)
+                else:
+                    accepted.append(plan)
+    # Longest jobs first so a batch does not end waiting on one large tree
+    accepted.sort(key=lambda p: p['minutes'], reverse=True)
+    return accepted, rejected
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate model calls, tokens and runtime for attack-defense tree jobs without calling the model.")
+    parser.add_argument('--capec-ids', nargs='+', default=[str(i) for i in range(1, 21)])
+    parser.add_argument('--languages', nargs='+', default=['non-technical', 'developer', 'expert'])
+    parser.add_argument('--syntaxes', nargs='+', default=['basic', 'countermeasures', 'full'])
+    parser.add_argument('--structured', action='store_true', help="Plan for structured_output=True")
+    parser.add_argument('--calibration', help="Latency log written by callGPT (LATENCY_LOG_FILE)")
+    parser.add_argument('--max-calls', type=int, help="Reject jobs needing more model calls than this")
+    parser.add_argument('--max-minutes', type=float, help="Reject jobs estimated to take longer than this")
+    parser.add_argument('--routes', help="JSON file with the model route for each prompt kind")
+    parser.add_argument('--output', help="Write the ordered plan as JSON")
+    args = parser.parse_args()
+
+    if args.routes:
+        aag.load_model_routes(args.routes)
+    calibration = load_calibration(args.calibration, aag.MODEL_ROUTES)
+    accepted, rejected = plan_jobs(args.capec_ids, args.languages, args.syntaxes, calibration,
+                                   args.structured, args.max_calls, args.max_minutes)
+
+    print(f"{'Job':<40} {'Calls':>6} {'Prompt tok':>11} {'Compl tok':>10} {'Minutes':>8}")
+    for plan in accepted:
+        job = f"CAPEC-{plan['capec_id']} {plan['language_complexity']} {plan['syntax_complexity']}"
+        print(f"{job:<40} {plan['calls']:>6} {plan['prompt_tokens']:>11} {plan['completion_tokens']:>10} {plan['minutes']:>8.2f}")
+    totals = {key: sum(plan[key] for plan in accepted) for key in ['calls', 'prompt_tokens', 'completion_tokens', 'minutes']}
+    print(f"\nTotal for {len(accepted)} jobs: {totals['calls']} calls, {totals['prompt_tokens']} prompt tokens, "
+          f"{totals['completion_tokens']} completion tokens, {totals['minutes']:.1f} minutes")
+    for plan in rejected:
+        print(f"Rejected CAPEC-{plan['capec_id']} with {plan['language_complexity']} and {plan['syntax_complexity']}: "
+              f"{plan['calls']} calls, {plan['minutes']:.2f} minutes")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'jobs': accepted, 'rejected': rejected, 'totals': totals, 'calibration': calibration}, f, indent=2)
+        print(f"Plan saved to '{args.output}'")
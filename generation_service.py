@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import autoAttackGeneration
+from autoAttackGeneration import build_attack_tree, score_attack_tree, render_attack_tree, load_glossary, \
+    load_model_routes, describe_model_routes, reset_call_stats, get_call_stats
+
+LANGUAGE_COMPLEXITIES = ['non-technical', 'developer', 'expert']
+SYNTAX_COMPLEXITIES = ['basic', 'countermeasures', 'full']
+
+class GenerationService:
+    def __init__(self, glossary_file="nist_glossary.json", output_dir=".", workers=2, max_queue=16, max_trees=256):
+        self.glossary_file = glossary_file
+        self.output_dir = output_dir
+        self.glossary_terms = load_glossary(glossary_file)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_queue)
+        # Most recently generated trees kept for /rescore, least recently used are dropped first
+        self.trees = OrderedDict()
+        self.max_trees = max_trees
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            return None
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def generate(self, capec_id, language_complexity, syntax_complexity, render, structured_output=False):
+        reset_call_stats()
+        full_tree = build_attack_tree(capec_id, language_complexity, syntax_complexity, structured_output=structured_output)
+        if full_tree is None:
+            return None
+        key = (str(capec_id), language_complexity, syntax_complexity)
+        with self.lock:
+            self.trees[key] = full_tree
+            self.trees.move_to_end(key)
+            while len(self.trees) > self.max_trees:
+                self.trees.popitem(last=False)
+        result = self._result(full_tree, capec_id, language_complexity, syntax_complexity, render)
+        result['metrics'].update(get_call_stats())
+        return result
+
+    def rescore(self, capec_id, language_complexity, syntax_complexity, render, reload_glossary):
+        key = (str(capec_id), language_complexity, syntax_complexity)
+        with self.lock:
+            full_tree = self.trees.get(key)
+            if full_tree is not None:
+                self.trees.move_to_end(key)
+        if full_tree is None:
+            return None
+        if reload_glossary:
+            self.glossary_terms = load_glossary(self.glossary_file)
+        return self._result(full_tree, capec_id, language_complexity, syntax_complexity, render)
+
+    def _result(self, full_tree, capec_id, language_complexity, syntax_complexity, render):
+        result = {
+            'capec_id': capec_id,
+            'language_complexity': language_complexity,
+            'syntax_complexity': syntax_complexity,
+            'metrics': score_attack_tree(full_tree, self.glossary_terms),
+            'routing': describe_model_routes(),
+            'output_file': None
+        }
+        if render:
+            output_filename = os.path.join(self.output_dir, f'attack_defense_tree_{language_complexity}_{syntax_complexity}_{capec_id}')
+            result['output_file'] = os.path.abspath(render_attack_tree(full_tree, output_filename))
+        return result
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'pending': self.service.pending, 'cached_trees': len(self.service.trees)})
+        else:
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path == '/generate':
+            fn = self.service.generate
+        elif self.path == '/rescore':
+            fn = self.service.rescore
+        else:
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError("body must be a JSON object")
+            args = [
+                body['capec_id'],
+                body.get('language_complexity', 'developer'),
+                body.get('syntax_complexity', 'full'),
+                body.get('render', False)
+            ]
+            # These values end up in the CSV and output paths, so only known values are accepted
+            if not re.fullmatch(r"[0-9]+", str(args[0])):
+                raise ValueError(f"capec_id must be a number, got {args[0]!r}")
+            if args[1] not in LANGUAGE_COMPLEXITIES:
+                raise ValueError(f"language_complexity must be one of {LANGUAGE_COMPLEXITIES}, got {args[1]!r}")
+            if args[2] not in SYNTAX_COMPLEXITIES:
+                raise ValueError(f"syntax_complexity must be one of {SYNTAX_COMPLEXITIES}, got {args[2]!r}")
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {'error': f"Invalid request: {e}"})
+            return
+        if fn == self.service.rescore:
+            args.append(body.get('reload_glossary', False))
+        else:
+            args.append(body.get('structured_output', False))
+
+        future = self.service.submit(fn, *args)
+        if future is None:
+            self.send_json(503, {'error': "Queue is full, try again later"})
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        if result is None:
+            self.send_json(404, {'error': f"No attack-defense tree for CAPEC-{args[0]} with {args[1]} and {args[2]}"})
+        else:
+            self.send_json(200, result)
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident attack-defense tree generation service.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=2, help="Trees generated concurrently")
+    parser.add_argument('--max-queue', type=int, default=16, help="Requests accepted before answering 503")
+    parser.add_argument('--glossary', default='nist_glossary.json')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--max-trees', type=int, default=256, help="Generated trees kept in memory for /rescore")
+    parser.add_argument('--routes', help="JSON file with the model route for each prompt kind")
+    parser.add_argument('--latency-log', help="Append the latency of every model call to this file, for cost_planner.py --calibration")
+    args = parser.parse_args()
+
+    if args.routes:
+        load_model_routes(args.routes)
+    if args.latency_log:
+        autoAttackGeneration.LATENCY_LOG_FILE = args.latency_log
+
+    GenerationRequestHandler.service = GenerationService(args.glossary, args.output_dir, args.workers, args.max_queue, args.max_trees)
+    server = ThreadingHTTPServer((args.host, args.port), GenerationRequestHandler)
+    print(f"Serving attack-defense tree generation on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,69 @@
+import json
+import zlib
+import struct
+
+SNAPSHOT_MAGIC = b"ATSNAP1\n"
+FLAG_DIMMED = 1
+FLAG_AND = 2
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def encode_tree(root):
+    # Labels are stored once in a string table, nodes in pre-order as (flags, label index, child count)
+    labels = {}
+    nodes = bytearray()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        label_index = labels.setdefault(node.label, len(labels))
+        flags = (FLAG_DIMMED if node.dimmed else 0) | (FLAG_AND if node.is_and else 0)
+        nodes.append(flags)
+        write_varint(nodes, label_index)
+        write_varint(nodes, len(node.children))
+        stack.extend(reversed(node.children))
+
+    out = bytearray()
+    write_varint(out, len(labels))
+    for label in labels:
+        encoded = label.encode('utf-8')
+        write_varint(out, len(encoded))
+        out += encoded
+    out += nodes
+    return zlib.compress(bytes(out), 9)
+
+def append_snapshot(snapshot_file, tree, metadata):
+    meta = json.dumps(metadata).encode('utf-8')
+    payload = encode_tree(tree)
+    with open(snapshot_file, 'ab') as f:
+        if f.tell() == 0:
+            f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('>II', len(meta), len(payload)))
+        f.write(meta)
+        f.write(payload)
+
+def iter_snapshot_records(snapshot_file):
+    with open(snapshot_file, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{snapshot_file} is not an attack tree snapshot file")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            meta_length, payload_length = struct.unpack('>II', header)
+            metadata = json.loads(f.read(meta_length).decode('utf-8'))
+            yield metadata, f.read(payload_length)
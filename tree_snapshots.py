@@ -0,0 +1,132 @@
+import os
+import csv
+import zlib
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from autoAttackGeneration import GraphNode, score_attack_tree, render_attack_tree, load_glossary
+from snapshot_format import FLAG_DIMMED, FLAG_AND, read_varint, iter_snapshot_records
+
+def decode_tree(payload):
+    data = zlib.decompress(payload)
+    label_count, pos = read_varint(data, 0)
+    labels = []
+    for _ in range(label_count):
+        length, pos = read_varint(data, pos)
+        labels.append(data[pos:pos + length].decode('utf-8'))
+        pos += length
+
+    root = None
+    pending = []
+    while pos < len(data):
+        flags = data[pos]
+        label_index, pos = read_varint(data, pos + 1)
+        child_count, pos = read_varint(data, pos)
+        node = GraphNode(labels[label_index], dimmed=bool(flags & FLAG_DIMMED), is_and=bool(flags & FLAG_AND))
+        if pending:
+            parent = pending[-1]
+            parent[0].children.append(node)
+            parent[1] -= 1
+            if parent[1] == 0:
+                pending.pop()
+        else:
+            root = node
+        if child_count:
+            pending.append([node, child_count])
+    return root
+
+class TreeSnapshot:
+    def __init__(self, metadata, payload):
+        self.metadata = metadata
+        self.payload = payload
+        self._tree = None
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = decode_tree(self.payload)
+        return self._tree
+
+def iter_snapshots(snapshot_file):
+    for metadata, payload in iter_snapshot_records(snapshot_file):
+        yield TreeSnapshot(metadata, payload)
+
+_worker_glossary_terms = None
+
+def _init_worker(glossary_file):
+    global _worker_glossary_terms
+    if glossary_file:
+        _worker_glossary_terms = load_glossary(glossary_file)
+
+def _rescore_snapshot(snapshot):
+    return {**snapshot.metadata, **score_attack_tree(snapshot.tree, _worker_glossary_terms)}
+
+def _render_snapshot(job):
+    index, snapshot, output_dir = job
+    metadata = snapshot.metadata
+    # The record index keeps repeated or differently routed snapshots of one job apart
+    output_filename = os.path.join(
+        output_dir,
+        f"attack_defense_tree_{metadata['language_complexity']}_{metadata['syntax_complexity']}_{metadata['capec_id']}_{index}"
+    )
+    return render_attack_tree(snapshot.tree, output_filename)
+
+def _iter_all_snapshots(snapshot_files):
+    for snapshot_file in snapshot_files:
+        yield from iter_snapshots(snapshot_file)
+
+def _map_bounded(executor, fn, jobs, window):
+    # Keeps at most `window` snapshots in flight so large snapshot files are streamed, results stay in order
+    futures = deque()
+    for job in jobs:
+        if len(futures) >= window:
+            yield futures.popleft().result()
+        futures.append(executor.submit(fn, job))
+    while futures:
+        yield futures.popleft().result()
+
+def rescore_snapshots(snapshot_files, glossary_file, output_file, workers=None):
+    workers = workers or os.cpu_count() or 1
+    count = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(glossary_file,)) as executor, \
+            open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = None
+        for result in _map_bounded(executor, _rescore_snapshot, _iter_all_snapshots(snapshot_files), workers * 4):
+            if writer is None:
+                writer = csv.DictWriter(csvfile, fieldnames=list(result.keys()), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow(result)
+            count += 1
+    print(f"Re-scored {count} trees to {output_file}")
+
+def render_snapshots(snapshot_files, output_dir, workers=None):
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = ((index, snapshot, output_dir) for index, snapshot in enumerate(_iter_all_snapshots(snapshot_files)))
+    count = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for _ in _map_bounded(executor, _render_snapshot, jobs, workers * 4):
+            count += 1
+    print(f"Rendered {count} trees to {output_dir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-score or re-render stored attack-defense tree snapshots without calling the model.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rescore_parser = subparsers.add_parser('rescore')
+    rescore_parser.add_argument('snapshots', nargs='+')
+    rescore_parser.add_argument('--glossary', default='nist_glossary.json')
+    rescore_parser.add_argument('--output', default='rescored_complexities.csv')
+    rescore_parser.add_argument('--workers', type=int, default=None)
+
+    render_parser = subparsers.add_parser('render')
+    render_parser.add_argument('snapshots', nargs='+')
+    render_parser.add_argument('--output-dir', default='rendered_trees')
+    render_parser.add_argument('--workers', type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == 'rescore':
+        rescore_snapshots(args.snapshots, args.glossary, args.output, args.workers)
+    else:
+        render_snapshots(args.snapshots, args.output_dir, args.workers)